@@ -1,11 +1,11 @@
 #!/usr/bin/env python
-from abc import ABC
+import functools
 from io import BytesIO
 from typing import Sequence
 
 import cairosvg
 import qrcode
-from PIL import Image, ImageDraw, ImageFont, ImageChops, ImageOps
+from PIL import Image, ImageDraw, ImageFont
 
 WHITE = 1
 BLACK = 0
@@ -17,152 +17,266 @@ PADDING = 2 # mm
 
 MAX_HEIGHT = 76 # px (???)
 
+# (left, top, right, bottom) of the region a widget draws into
+Box = tuple[int, int, int, int]
 
-def px(l) -> int:
-    return int(DPI * l * 0.03937007874015748)
 
+def px(l: int) -> int:
+    # mm to px, in integer arithmetic (1 inch = 25.4mm)
+    return DPI * l * 10 // 254
 
-def trim(im):
-    # from https://stackoverflow.com/questions/10615901/trim-whitespace-using-pil
-    bg = Image.new(im.mode, im.size, im.getpixel((0,0)))
-    diff = ImageChops.difference(im, bg)
-    diff = ImageChops.add(diff, diff, 2.0, -100)
-    bbox = diff.getbbox()
-    if bbox:
-        return im.crop(bbox)
 
+@functools.lru_cache(maxsize=32)
+def _font(path: str, size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(path, size=size)
 
 
-class Widget(ABC):
-    def render(self, draw: ImageDraw.Draw) -> None:
-        pass
+# scratch draw for measuring text the same way rendering will lay it out
+_measure = ImageDraw.Draw(Image.new("1", (1, 1)))
+
+
+@functools.lru_cache(maxsize=512)
+def _text_bbox(text: str, size: int, font_path: str) -> Box:
+    return _measure.textbbox((0, 0), text, font=_font(font_path, size))
+
+
+@functools.lru_cache(maxsize=512)
+def _render_text(
+    text: str, size: int, font_path: str, phase: (float, float)
+) -> (Image.Image, (int, int)):
+    # returns a mask of the text drawn at the sub-pixel phase of its origin,
+    # and where the integer part of that origin lies within the mask
+    left, top, right, bottom = _text_bbox(text, size, font_path)
+    # 2px of slack around the measured box for ink moved by the phase
+    ox, oy = max(0, 2 - left), max(0, 2 - top)
+    mask = Image.new("1", (ox + right + 2, oy + bottom + 2), 0)
+    ImageDraw.Draw(mask).text(
+        (ox + phase[0], oy + phase[1]), text, font=_font(font_path, size), fill=1
+    )
+    return mask, (ox, oy)
+
+
+@functools.lru_cache(maxsize=32)
+def _marker(height: int) -> Image.Image:
+    # 1px wide mask column, set for 5 rows out of every 8
+    pattern = (b"\xff" * 5 + b"\x00" * 3) * (height // 8 + 1)
+    return Image.frombytes("L", (1, height), pattern[:height]).convert("1")
+
+
+@functools.lru_cache(maxsize=256)
+def _render_qr(data: str, width: int, height: int) -> Image.Image:
+    qr = qrcode.QRCode(box_size=1, border=0)
+    qr.add_data(data)
+    qr.make()
+    img_qr = qr.make_image().resize((width, height), resample=Image.NEAREST)
+    # mask of the dark modules, stamped like every other widget's ink
+    return img_qr.convert("L").point(lambda p: 255 - p, "1")
+
+
+@functools.lru_cache(maxsize=256)
+def _render_svg(src: str, width: int, height: int) -> Image.Image:
+    with open(src, 'rb') as svg_file:
+        svg_content = svg_file.read()
+    png_bytes = cairosvg.svg2png(
+        bytestring=svg_content,
+        output_width=width,
+        output_height=height,
+    )
+    alpha_channel = Image.open(BytesIO(png_bytes)).getchannel("A")
+    # mask of the opaque strokes, stamped like every other widget's ink
+    return alpha_channel.point(lambda a: 255 if a >= 128 else 0, "1")
+
+
+class Widget:
+    __slots__ = ()
+
+    def render(self, draw: ImageDraw.Draw, box: Box) -> None:
+        raise NotImplementedError
 
     def layout(self, width: int, height: int) -> (int, int):
         return (width, height)
 
 
 class Label(Widget):
+    __slots__ = ("width", "height", "child")
+
     def __init__(self, width: int, height: int, child: Widget) -> None:
         self.width = width
         self.height = height
         self.child = child
 
-    def render(self, draw: ImageDraw.Draw) -> None:
+    def render(self, draw: ImageDraw.Draw, box: Box) -> None:
+        left, top = box[:2]
+
         # markers
         width, height = self.width, self.height
-        for x in [0, width-1]:
-            for y in range(0, height, 8):
-                draw.line([(x, y), (x, y + 4)], fill=BLACK)
+        marker = _marker(height)
+        draw.bitmap((left, top), marker, fill=BLACK)
+        draw.bitmap((left + width - 1, top), marker, fill=BLACK)
 
-        image = Image.new("1", (self.width - 2, self.height), WHITE)
-        self.child.render(ImageDraw.Draw(image))
+        # child goes between the marker columns; like every other widget it
+        # isn't clipped, so one drawing past its box can cover the markers
+        self.child.render(draw, (left + 1, top, left + width - 1, top + height))
 
-        draw._image.paste(image, (1, 0))
 
+class _Container(Widget):
+    __slots__ = ("children", "_layout_cache")
 
-class Horizontal(Widget):
     def __init__(self, children: Sequence[Widget]) -> None:
         self.children = children
+        self._layout_cache = None
+
+    def _layout_children(self, width: int, height: int) -> list:
+        # keep only the last layout, keyed on the size and the exact children
+        # it was computed for; holding the children keeps their ids from
+        # being reused while the entry lives
+        key = (width, height, tuple(self.children))
+        if self._layout_cache is None or self._layout_cache[0] != key:
+            self._layout_cache = (key, self._compute_layout(width, height))
+        return self._layout_cache[1]
+
+    def render(self, draw: ImageDraw.Draw, box: Box) -> None:
+        for child, child_box in zip(self.children, self._child_boxes(box)):
+            child.render(draw, child_box)
+
 
-    def render(self, draw: ImageDraw.Draw) -> None:
-        width, height = draw.im.size
+class Horizontal(_Container):
+    __slots__ = ()
 
+    def _compute_layout(self, width: int, height: int) -> list[tuple[int, int, int]]:
         offered_child_width = int(width / len(self.children))
-        spare_width = width
-        num_flexible = 0
-        for child in self.children:
-            desired_width = child.layout(offered_child_width, height)[0]
-            if desired_width == offered_child_width:
-                num_flexible += 1
-            else:
-                spare_width -= desired_width
+        desired_widths = [
+            child.layout(offered_child_width, height)[0] for child in self.children
+        ]
+        # children taking exactly what they're offered are flexible and
+        # split whatever the fixed-width children leave
+        num_flexible = desired_widths.count(offered_child_width)
+        spare_width = width - sum(desired_widths) + num_flexible * offered_child_width
         flexible_child_width = (
             offered_child_width
             if num_flexible == 0
             else int(spare_width / num_flexible)
         )
 
+        boxes = []
         x = 0
-        for i, child in enumerate(self.children):
-            child_layout = child.layout(flexible_child_width, height)
-            image = Image.new("1", child_layout, WHITE)
-            child.render(ImageDraw.Draw(image))
-            draw._image.paste(image, (x, 0))
-            x += child_layout[0]
+        for child in self.children:
+            child_width, child_height = child.layout(flexible_child_width, height)
+            boxes.append((x, child_width, child_height))
+            x += child_width
+        return boxes
 
+    def _child_boxes(self, box: Box) -> list[Box]:
+        left, top, right, bottom = box
+        boxes = self._layout_children(right - left, bottom - top)
+        return [
+            (left + x, top, left + x + child_width, top + child_height)
+            for x, child_width, child_height in boxes
+        ]
 
-class Vertical(Widget):
-    def __init__(self, children: Sequence[Widget]) -> None:
-        self.children = children
 
-    def render(self, draw: ImageDraw.Draw) -> None:
-        # TODO: this is super basic, need to take into account flexible child
-        width, height = draw.im.size
+class Vertical(_Container):
+    __slots__ = ()
 
+    def _compute_layout(self, width: int, height: int) -> list[tuple[int, int]]:
+        # TODO: this is super basic, need to take into account flexible child
         child_height = int(height / len(self.children))
-        for i, child in enumerate(self.children):
-            image = Image.new("1", (width, child_height), WHITE)
-            child.render(ImageDraw.Draw(image))
-            draw._image.paste(image, (0, i * child_height))
+        return [(i * child_height, child_height) for i in range(len(self.children))]
+
+    def _child_boxes(self, box: Box) -> list[Box]:
+        left, top, right, bottom = box
+        boxes = self._layout_children(right - left, bottom - top)
+        return [(left, top + y, right, top + y + child_height) for y, child_height in boxes]
 
 
 class Text(Widget):
+    __slots__ = ("text", "size")
+
     def __init__(self, text: str, size: int = 20) -> None:
         self.text = text
         self.size = size
 
-    def render(self, draw: ImageDraw.Draw) -> None:
-        W, H = draw.im.size
-        font = ImageFont.truetype("fonts/Roboto-Bold.ttf", size=self.size)
-        _, _, w, h = draw.textbbox((0, 0), self.text, font=font)
-        draw.text(((W-w)/2, (H-h)/2), self.text, font=font, fill=BLACK)
+    def render(self, draw: ImageDraw.Draw, box: Box) -> None:
+        left, top, right, bottom = box
+        W, H = right - left, bottom - top
+        font_path = "fonts/Roboto-Bold.ttf"
+        _, _, w, h = _text_bbox(self.text, self.size, font_path)
+        x, y = left + (W-w)/2, top + (H-h)/2
+        if x < 0 or y < 0:
+            # draw.text truncates negative origins towards zero, which a
+            # cached mask placed by its integer origin can't reproduce
+            font = _font(font_path, self.size)
+            draw.text((x, y), self.text, font=font, fill=BLACK)
+            return
+        mask, (ox, oy) = _render_text(self.text, self.size, font_path, (x % 1, y % 1))
+        draw.bitmap((int(x) - ox, int(y) - oy), mask, fill=BLACK)
 
 
 class QRCode(Widget):
+    __slots__ = ("data", "padding")
+
     def __init__(self, data: str, padding: int = 0) -> None:
         self.data = data
         self.padding = padding
 
-    def render(self, draw: ImageDraw.Draw) -> None:
-        width, height = draw.im.size
+    def render(self, draw: ImageDraw.Draw, box: Box) -> None:
+        left, top, right, bottom = box
+        width, height = right - left, bottom - top
         padding = self.padding
-        qr = qrcode.QRCode(box_size=1)
-        qr.add_data(self.data)
-        qr.make()
-        img_qr = trim(qr.make_image()).resize((width * (100 - 2 * padding) // 100, height * (100 - 2 * padding) // 100))
-        draw._image.paste(img_qr, (width * padding // 100, height * padding // 100))
+        mask = _render_qr(
+            self.data,
+            width * (100 - 2 * padding) // 100,
+            height * (100 - 2 * padding) // 100,
+        )
+        draw.bitmap((left + width * padding // 100, top + height * padding // 100), mask, fill=BLACK)
 
     def layout(self, _width: int, height: int) -> (int, int):
         return (height, height)
 
 
 class SVG(Widget):
+    __slots__ = ("src", "padding")
+
     def __init__(self, src: str, padding: int = 0) -> None:
         self.src = src
         self.padding = padding
 
-    def render(self, draw: ImageDraw.Draw) -> None:
-        width, height = draw.im.size
+    def render(self, draw: ImageDraw.Draw, box: Box) -> None:
+        left, top, right, bottom = box
+        width, height = right - left, bottom - top
         padding = self.padding
-        with open(self.src, 'rb') as svg_file:
-            svg_content = svg_file.read()
-        png_bytes = cairosvg.svg2png(
-            bytestring=svg_content,
-            output_width=width * (100 - 2 * padding) // 100,
-            output_height=height * (100 - 2 * padding) // 100
+        mask = _render_svg(
+            self.src,
+            width * (100 - 2 * padding) // 100,
+            height * (100 - 2 * padding) // 100,
         )
-        svg_image = Image.open(BytesIO(png_bytes))
-        _r, _g, _b, alpha_channel = svg_image.split()
-        image = ImageOps.invert(alpha_channel)
-        draw._image.paste(image, (width * padding // 100, height * padding // 100))
+        draw.bitmap((left + width * padding // 100, top + height * padding // 100), mask, fill=BLACK)
 
     def layout(self, _width: int, height: int) -> (int, int):
         return (height, height)
 
 
+IMAGE_WIDTH = px(LABEL_WIDTH + PADDING)
+IMAGE_HEIGHT = min(px(TAPE_WIDTH), MAX_HEIGHT)
+
+_image = Image.new("1", (IMAGE_WIDTH, IMAGE_HEIGHT), WHITE)
+
+
+def build_label(label: Label) -> Image.Image:
+    # the same image is cleared and reused on every call, copy() it to keep it
+    if label.width > IMAGE_WIDTH or label.height > IMAGE_HEIGHT:
+        raise ValueError(
+            f"label is {label.width}x{label.height}px, "
+            f"the tape image is only {IMAGE_WIDTH}x{IMAGE_HEIGHT}px"
+        )
+    _image.paste(WHITE, (0, 0, IMAGE_WIDTH, IMAGE_HEIGHT))
+    label.render(ImageDraw.Draw(_image), (0, 0, label.width, label.height))
+    return _image
+
+
 label = Label(
     px(LABEL_WIDTH),
-    min(px(TAPE_WIDTH), MAX_HEIGHT),
+    IMAGE_HEIGHT,
     Horizontal([
         SVG("icons/screw-head-phillips.svg", padding=5),
         Vertical([
@@ -181,9 +295,5 @@ label = Label(
     ]),
 )
 
-width, height = px(LABEL_WIDTH + PADDING), min(px(TAPE_WIDTH), MAX_HEIGHT)
-image = Image.new("1", (width, height), WHITE)
-draw = ImageDraw.Draw(image)
-label.render(draw)
-
-image.save("hello_world.png")
+if __name__ == "__main__":
+    build_label(label).save("hello_world.png")
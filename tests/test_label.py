@@ -0,0 +1,53 @@
+from pathlib import Path
+
+import pytest
+from PIL import Image, ImageChops, ImageDraw
+
+from label import BLACK, WHITE, Horizontal, QRCode, Text, Vertical
+
+MARGIN = 50
+
+
+@pytest.fixture(autouse=True)
+def repo_root(monkeypatch):
+    # widgets load fonts and icons relative to the repo root
+    monkeypatch.chdir(Path(__file__).parent.parent)
+
+
+def render(widget, size, box=None):
+    # the margin leaves room for anything drawn outside the widget's box
+    width, height = size
+    image = Image.new("1", (width + 2 * MARGIN, height + 2 * MARGIN), WHITE)
+    if box is None:
+        box = (MARGIN, MARGIN, MARGIN + width, MARGIN + height)
+    widget.render(ImageDraw.Draw(image), box)
+    return image
+
+
+def test_mutated_children_are_laid_out_again():
+    mutated = Vertical([Text("A", 10)])
+    render(mutated, (40, 30))
+    mutated.children.append(Text("B", 10))
+
+    fresh = Vertical([Text("A", 10), Text("B", 10)])
+    assert render(mutated, (40, 30)).tobytes() == render(fresh, (40, 30)).tobytes()
+
+
+@pytest.mark.parametrize(
+    "qr",
+    [QRCode("hello"), Vertical([QRCode("hello")])],
+    ids=["qrcode", "nested"],
+)
+def test_children_only_add_ink(qr):
+    # the overflowing text must not be erased by the QR code's light modules
+    tree = Horizontal([Text("Pan Head Screws", 14), qr])
+    size = (60, 20)
+    expected = Image.new("1", render(tree, size).size, WHITE)
+    for child, box in zip(
+        tree.children,
+        tree._child_boxes((MARGIN, MARGIN, MARGIN + size[0], MARGIN + size[1])),
+    ):
+        expected = ImageChops.logical_and(expected, render(child, size, box))
+    result = render(tree, size)
+    assert result.histogram()[BLACK] > 0
+    assert result.tobytes() == expected.tobytes()